@@ -0,0 +1,373 @@
+# SPDX-FileCopyrightText: 2024 Tim Chinowsky
+# SPDX-License-Identifier: MIT
+
+# Packed recording format for TAC5 captures.  Words read from the TAC5 hold
+# `width` significant bits in 32-bit 'L' words, so writing them as-is wastes
+# up to half of the SD card bandwidth.  An Encoder packs each block down to
+# `width` bits per sample, and optionally applies a lossless stage
+# (per-channel delta followed by Rice coding), keeping whichever is smaller.
+# The Rice stage is experimental on the device: it still emits bits with a
+# Python loop per sample and hasn't been shown to fit the block period on
+# RP2350, so tape() drops it as soon as a block overruns.
+#
+# Words are handled as 'I' arrays, which are 32 bits on both CircuitPython
+# and the host.  This module only needs array and struct, so the same file
+# decodes recordings on the host:
+#
+#   python pack.py capture.tac5 capture.raw
+#
+# writes signed 32-bit raw (headerless) samples which Audacity can import.
+#
+# File layout, all little-endian:
+#   header:  magic 'TAC5', version, reserved (0), channels, width, sample_rate
+#   blocks:  mode, rice parameter k, frames, payload bytes, payload
+
+import array
+import struct
+import time
+
+# Packing 16, 20 and 24 bit words is done with strided byte copies when
+# ulab (or numpy on the host) is available, so it doesn't cost a Python
+# loop iteration per sample, and so are the deltas for the Rice stage.
+# Without it the per-sample loops below are used.
+try:
+    from ulab import numpy as np
+except ImportError:
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+
+MAGIC = b'TAC5'
+VERSION = 1
+HEADER = '<4sBBBBI'
+BLOCK = '<BBII'
+
+MODE_PACKED = 0
+MODE_RICE = 1
+
+# unary quotients this long are escaped and followed by the zigzagged delta
+# in width+1 bits, which bounds the size of a block full of noise or clipping
+ESCAPE = 24
+
+
+class BitWriter():
+    def __init__(self):
+        self.data = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        # at most 16 bits go into the accumulator at a time, which keeps it
+        # below 2**23 and so within MicroPython's small int range
+        while bits > 16:
+            self.write(value & 0xFFFF, 16)
+            value >>= 16
+            bits -= 16
+        self.acc |= value << self.bits
+        self.bits += bits
+        while self.bits >= 8:
+            self.data.append(self.acc & 0xFF)
+            self.acc >>= 8
+            self.bits -= 8
+
+    def flush(self):
+        if self.bits > 0:
+            self.data.append(self.acc & 0xFF)
+        self.acc = 0
+        self.bits = 0
+        return self.data
+
+
+class BitReader():
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        self.acc = 0
+        self.bits = 0
+
+    def read(self, bits):
+        while self.bits < bits:
+            self.acc |= self.data[self.pos] << self.bits
+            self.pos += 1
+            self.bits += 8
+        value = self.acc & ((1 << bits) - 1)
+        self.acc >>= bits
+        self.bits -= bits
+        return value
+
+    def unary(self, limit):
+        count = 0
+        while count < limit and self.read(1):
+            count += 1
+        return count
+
+
+def pack(buffer, width):
+    if width == 32:
+        return bytearray(buffer)
+    if np is not None and width in (16, 20, 24):
+        return pack_strided(buffer, width)
+    mask = (1 << width) - 1
+    if width == 16:
+        return bytearray(array.array('H', [w & mask for w in buffer]))
+    if width == 24:
+        out = bytearray(3 * len(buffer))
+        j = 0
+        for w in buffer:
+            out[j] = w & 0xFF
+            out[j+1] = (w >> 8) & 0xFF
+            out[j+2] = (w >> 16) & 0xFF
+            j += 3
+        return out
+    writer = BitWriter()
+    for w in buffer:
+        writer.write(w & mask, width)
+    return writer.flush()
+
+
+def pack_strided(buffer, width):
+    # little-endian words, so the low bytes of word i are raw[4*i:4*i+3]
+    n = len(buffer)
+    raw = np.frombuffer(bytearray(buffer), dtype=np.uint8)
+    if width != 20:
+        size = width // 8
+        out = np.zeros(size * n, dtype=np.uint8)
+        for j in range(size):
+            out[j::size] = raw[j:4*n:4]
+        return bytearray(out.tobytes())
+    # two 20 bit samples make five bytes, LSB first like BitWriter
+    pairs = n // 2
+    b0, b1, b2 = raw[0:8*pairs:8], raw[1:8*pairs:8], raw[2:8*pairs:8]
+    c0, c1, c2 = raw[4:8*pairs:8], raw[5:8*pairs:8], raw[6:8*pairs:8]
+    out = np.zeros(5 * pairs, dtype=np.uint8)
+    out[0::5] = b0
+    out[1::5] = b1
+    out[2::5] = np.bitwise_or(np.bitwise_and(b2, 0x0F), np.left_shift(np.bitwise_and(c0, 0x0F), 4))
+    out[3::5] = np.bitwise_or(np.right_shift(c0, 4), np.left_shift(np.bitwise_and(c1, 0x0F), 4))
+    out[4::5] = np.bitwise_or(np.right_shift(c1, 4), np.left_shift(np.bitwise_and(c2, 0x0F), 4))
+    data = bytearray(out.tobytes())
+    if n % 2:
+        w = buffer[n-1]
+        data.extend(bytes((w & 0xFF, (w >> 8) & 0xFF, (w >> 16) & 0x0F)))
+    return data
+
+
+def unpack(data, width, count):
+    if width == 32:
+        return array.array('I', bytes(data[:4*count]))
+    if width == 16:
+        return array.array('I', array.array('H', bytes(data[:2*count])))
+    words = array.array('I', [0] * count)
+    if width == 24:
+        for i in range(count):
+            j = 3 * i
+            words[i] = data[j] | (data[j+1] << 8) | (data[j+2] << 16)
+        return words
+    reader = BitReader(data)
+    for i in range(count):
+        words[i] = reader.read(width)
+    return words
+
+
+def residuals(buffer, channels, width):
+    # Zigzagged per-channel deltas, each block starting from zero so blocks
+    # decode independently.  Returns them with their mean.
+    n = len(buffer)
+    mask = (1 << width) - 1
+    sign = 1 << (width - 1)
+    full = 1 << width
+    # ulab has no 32 bit integers, so it works in single precision floats,
+    # which hold the zigzagged deltas exactly up to 23 bit samples
+    if np is not None and n % channels == 0 and (hasattr(np, 'int64') or width < 24):
+        dtype = np.int64 if hasattr(np, 'int64') else np.float
+        halves = np.frombuffer(bytearray(buffer), dtype=np.uint16)
+        v = np.array(np.bitwise_and(halves[0:2*n:2], mask & 0xFFFF), dtype=dtype)
+        if width > 16:
+            v = v + np.array(np.bitwise_and(halves[1:2*n:2], mask >> 16), dtype=dtype) * 65536
+        v = v - (v >= sign) * full
+        v = v.reshape((n // channels, channels))
+        d = v.copy()
+        d[1:] = v[1:] - v[:-1]
+        d = d.flatten()
+        u = abs(d) * 2 - (d < 0)
+        return u.tolist(), np.mean(u)
+    last = [0] * channels
+    u = [0] * n
+    total = 0
+    c = 0
+    for i in range(n):
+        s = buffer[i] & mask
+        if s & sign:
+            s -= full
+        d = s - last[c]
+        last[c] = s
+        c += 1
+        if c == channels:
+            c = 0
+        u[i] = d << 1 if d >= 0 else (-d << 1) - 1
+        total += u[i]
+    return u, total / n if n > 0 else 0
+
+
+def rice_encode(buffer, channels, width, k):
+    # Rice codes the residuals with parameter k.  Returns the payload and
+    # the parameter for the next block, close to log2 of this block's mean
+    # residual, so each block is only coded once.
+    u_all, mean = residuals(buffer, channels, width)
+    kmask = (1 << k) - 1
+    escape_code = (1 << ESCAPE) - 1
+    writer = BitWriter()
+    write = writer.write
+    for u in u_all:
+        u = int(u)
+        q = u >> k
+        if q < ESCAPE:
+            # q ones then a zero, then the k low bits
+            write((1 << q) - 1, q + 1)
+            if k > 0:
+                write(u & kmask, k)
+        else:
+            write(escape_code, ESCAPE)
+            write(u, width + 1)
+
+    next_k = 0
+    mean = int(mean)
+    while mean > 1:
+        mean >>= 1
+        next_k += 1
+    return writer.flush(), next_k
+
+
+def rice_decode(data, k, frames, channels, width):
+    mask = (1 << width) - 1
+    reader = BitReader(data)
+    words = array.array('I', [0] * (frames * channels))
+    last = [0] * channels
+    for i in range(frames * channels):
+        q = reader.unary(ESCAPE)
+        if q < ESCAPE:
+            u = (q << k) | reader.read(k) if k > 0 else q
+        else:
+            u = reader.read(width + 1)
+        d = u >> 1 if not u & 1 else -((u + 1) >> 1)
+        c = i % channels
+        s = last[c] + d
+        last[c] = s
+        words[i] = s & mask
+    return words
+
+
+class Encoder():
+    """
+    Encodes blocks of recorded words into the packed format.
+
+    >>> e = pack.Encoder(channels=8, width=24, sample_rate=16000, rice=True)
+    >>> f.write(e.header())
+    >>> f.write(e.encode(t.pcm.pio.last_read))
+    """
+    def __init__(self, channels=2, width=32, sample_rate=16000, rice=False):
+        if width < 1 or width > 32:
+            raise ValueError("unsupported width")
+        self.channels = channels
+        self.width = width
+        self.sample_rate = sample_rate
+        self.rice = rice
+        self.k = width // 2
+        self.blocks = 0
+        self.overruns = 0
+        self.max_encode_ns = 0
+
+    def header(self):
+        # each block records its own mode, so the file header doesn't say
+        # whether Rice coding was used
+        return struct.pack(HEADER, MAGIC, VERSION, 0, self.channels, self.width, self.sample_rate)
+
+    def encode(self, buffer):
+        # Each block has to be encoded within its own block period.  Only the
+        # encoding is timed, not writing the result, and if the Rice stage
+        # makes a block overrun it is dropped for the rest of the recording.
+        t0 = time.monotonic_ns()
+        frames = len(buffer) // self.channels
+        payload = pack(buffer, self.width)
+        mode = MODE_PACKED
+        k = 0
+        rice = self.rice
+        if rice:
+            # the parameter comes from the previous block so the block is
+            # only traversed once; packing wins if it turns out a poor fit
+            rice_payload, next_k = rice_encode(buffer, self.channels, self.width, self.k)
+            if len(rice_payload) < len(payload):
+                mode = MODE_RICE
+                k = self.k
+                payload = rice_payload
+            self.k = next_k
+        block = struct.pack(BLOCK, mode, k, frames, len(payload)) + payload
+        elapsed = time.monotonic_ns() - t0
+        self.blocks += 1
+        self.max_encode_ns = max(self.max_encode_ns, elapsed)
+        if elapsed > frames * 1_000_000_000 // self.sample_rate:
+            self.overruns += 1
+            if rice:
+                print('rice coding too slow, packing only')
+                self.rice = False
+        return block
+
+
+def read_header(f):
+    data = f.read(struct.calcsize(HEADER))
+    magic, version, reserved, channels, width, sample_rate = struct.unpack(HEADER, data)
+    if magic != MAGIC:
+        raise ValueError("not a packed TAC5 recording")
+    if version != VERSION:
+        raise ValueError("unsupported version")
+    return channels, width, sample_rate
+
+
+def blocks(f, channels, width):
+    block_size = struct.calcsize(BLOCK)
+    while True:
+        data = f.read(block_size)
+        if len(data) < block_size:
+            return
+        mode, k, frames, length = struct.unpack(BLOCK, data)
+        payload = f.read(length)
+        if mode == MODE_PACKED:
+            yield unpack(payload, width, frames * channels)
+        elif mode == MODE_RICE:
+            yield rice_decode(payload, k, frames, channels, width)
+        else:
+            raise ValueError("unsupported block mode")
+
+
+def decode(filename):
+    """
+    Returns (channels, width, sample_rate, words), with words holding the
+    samples exactly as they were read from the TAC5.
+    """
+    words = array.array('I')
+    with open(filename, 'rb') as f:
+        channels, width, sample_rate = read_header(f)
+        for block in blocks(f, channels, width):
+            words.extend(block)
+    return channels, width, sample_rate, words
+
+
+def to_raw(infile, outfile):
+    # signed 32-bit raw, left-justified, like the files in samples/
+    with open(infile, 'rb') as f, open(outfile, 'wb') as out:
+        channels, width, sample_rate = read_header(f)
+        sign = 1 << (width - 1)
+        for block in blocks(f, channels, width):
+            raw = array.array('i', [0] * len(block))
+            for i, w in enumerate(block):
+                if w & sign:
+                    w -= 1 << width
+                raw[i] = w << (32 - width)
+            out.write(raw)
+    print(f'{channels} channels, {width} bits, {sample_rate} Hz')
+
+
+if __name__ == '__main__':
+    import sys
+    to_raw(sys.argv[1], sys.argv[2])
@@ -0,0 +1,229 @@
+# SPDX-FileCopyrightText: 2024 Tim Chinowsky
+# SPDX-License-Identifier: MIT
+
+# Cooperative asyncio versions of the blocking loops in tac5.  Buffer
+# service (refilling the play buffer, draining the record buffer) has
+# priority: every other task waits in slack() until the last buffer was
+# serviced recently enough that there is at least half a block period left
+# before the next one is due.  Each task is timed so that starvation shows
+# up in the telemetry.
+#
+# >>> import tac5, scheduler
+# >>> t = tac5.TAC5()
+# >>> t.play()
+# playing...
+# >>> s = scheduler.Scheduler(t)
+# >>> s.run(s.play('/count_8ch_32bit_16000Hz.raw'), s.console(), s.telemetry(5))
+#
+# then at the console, while the file keeps playing:
+#
+#   w 0x50 0x2B    write register 0x50 on all codecs
+#   r 0x50         read register 0x50 from all codecs
+#   s              print task timing
+#   q              stop all tasks
+
+import asyncio
+import time
+import usb_cdc
+
+import tac5
+
+
+class TaskStats():
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.busy_ns = 0
+        self.max_busy_ns = 0
+        self.max_wait_ns = 0
+        self.t0 = 0
+
+    def __enter__(self):
+        self.t0 = time.monotonic_ns()
+        return self
+
+    def __exit__(self, *args):
+        busy = time.monotonic_ns() - self.t0
+        self.runs += 1
+        self.busy_ns += busy
+        self.max_busy_ns = max(self.max_busy_ns, busy)
+
+    def waited(self, wait):
+        self.max_wait_ns = max(self.max_wait_ns, wait)
+
+
+class Scheduler():
+    def __init__(self, codec):
+        self.tac5 = codec
+        self.running = True
+        self.stats = {}
+        self.period_ns = 0
+        self.last_service_ns = 0
+        self.stalled_ns = 0
+        self.max_gap_ns = 0
+        self.late = 0
+
+    def task(self, name):
+        if name not in self.stats:
+            self.stats[name] = TaskStats(name)
+        return self.stats[name]
+
+    def serviced(self, samples):
+        # called by the buffer tasks each time a block is filled or drained
+        now = time.monotonic_ns()
+        self.period_ns = samples // self.tac5.channels * 1_000_000_000 // self.tac5.sample_rate
+        if self.last_service_ns > 0:
+            gap = now - self.last_service_ns
+            self.max_gap_ns = max(self.max_gap_ns, gap)
+            # blocks arrive once per period, so a longer gap means the
+            # buffer task was held off by something else, unless slack()
+            # already counted it as a stall
+            if gap > self.period_ns * 3 // 2 and self.stalled_ns != self.last_service_ns:
+                self.late += 1
+        self.last_service_ns = now
+
+    async def slack(self, name):
+        # wait until buffer service isn't due for at least half a period.  If
+        # nothing has been serviced for two periods the transfer has stalled
+        # or ended, so count that as late once and carry on rather than
+        # starving every other task (including the console's q).
+        stats = self.task(name)
+        t0 = time.monotonic_ns()
+        while self.running and self.period_ns > 0:
+            since = time.monotonic_ns() - self.last_service_ns
+            if since <= self.period_ns // 2:
+                break
+            if since > self.period_ns * 2:
+                if self.stalled_ns != self.last_service_ns:
+                    self.stalled_ns = self.last_service_ns
+                    self.late += 1
+                break
+            await asyncio.sleep(0)
+        stats.waited(time.monotonic_ns() - t0)
+        return stats
+
+    async def play(self, filename, repeat=True, process=None):
+        pio = self.tac5.pcm.pio
+        stats = self.task('play')
+        print('opening', filename, '...')
+        with open(filename, 'rb') as f:
+            while self.running:
+                b = pio.last_write
+                if len(b) > 0:
+                    with stats:
+                        tac5.status.value = True
+                        n = f.readinto(b)
+                        if n == 0:
+                            if not repeat:
+                                # just this task ends, the others carry on
+                                tac5.status.value = False
+                                return
+                            f.seek(0)
+                            n = f.readinto(b)
+                        if process is not None:
+                            pio.process(b, parameters=process)
+                        tac5.status.value = False
+                    self.serviced(len(b))
+                await asyncio.sleep(0)
+
+    async def tape(self, filename, packed=False, rice=False, blocks=None):
+        # same options and file formats as TAC5.tape()
+        pio = self.tac5.pcm.pio
+        stats = self.task('tape')
+        with open(filename, 'wb') as f:
+            writer = self.tac5.tape_writer(f, packed=packed, rice=rice)
+            while self.running and (blocks is None or writer.blocks < blocks):
+                b = pio.last_read
+                if len(b) > 0:
+                    with stats:
+                        writer.write(b)
+                    self.serviced(len(b))
+                await asyncio.sleep(0)
+        return writer.report()
+
+    async def lock(self, name):
+        # wait for the I2C bus without spinning, then release it so the
+        # synchronous register methods can take it; no other task can run
+        # between here and their try_lock()
+        i2c = self.tac5.i2c
+        await self.slack(name)
+        while not i2c.try_lock():
+            await asyncio.sleep(0)
+            await self.slack(name)
+        i2c.unlock()
+
+    async def write_reg(self, reg, data, page=0, address='all'):
+        await self.lock('i2c')
+        with self.task('i2c'):
+            self.tac5.write_reg(reg, data, page=page, address=address)
+
+    async def read_reg(self, reg, page=0, address='all'):
+        await self.lock('i2c')
+        with self.task('i2c'):
+            return self.tac5.read_reg(reg, page=page, address=address)
+
+    async def console(self, serial=None):
+        if serial is None:
+            serial = usb_cdc.console
+        line = ''
+        while self.running:
+            stats = await self.slack('console')
+            with stats:
+                line += tac5.read_serial(serial)
+            while '\n' in line or '\r' in line:
+                command, line = line.replace('\r', '\n').split('\n', 1)
+                await self.command(command.split())
+            await asyncio.sleep(0)
+
+    async def command(self, words):
+        if len(words) == 0:
+            return
+        try:
+            if words[0] == 'w':
+                await self.write_reg(int(words[1], 0), int(words[2], 0))
+            elif words[0] == 'r':
+                print([f'0x{v:02x}' for v in await self.read_reg(int(words[1], 0))])
+            elif words[0] == 's':
+                self.show()
+            elif words[0] == 'q':
+                self.running = False
+            else:
+                print('commands: w reg value, r reg, s, q')
+        except (IndexError, ValueError) as e:
+            print('bad command:', e)
+
+    async def telemetry(self, interval=1):
+        while self.running:
+            await asyncio.sleep(interval)
+            await self.slack('telemetry')
+            with self.task('telemetry'):
+                self.show()
+
+    async def test(self, slip_time=10):
+        buffer = self.tac5.record_loop_buffer
+        print(f'\nWatching for slip for {slip_time} seconds...')
+        slip_count = 0
+        last_rec = buffer[0]
+        t0 = time.monotonic()
+        while self.running and time.monotonic() < t0 + slip_time:
+            stats = await self.slack('test')
+            with stats:
+                r = buffer[0]
+                if r != last_rec:
+                    slip_count += 1
+                    last_rec = r
+            await asyncio.sleep(0)
+        print(f'\nSlip: {slip_count}')
+        return slip_count
+
+    def show(self):
+        print(f'\nperiod {self.period_ns // 1000} us, max gap {self.max_gap_ns // 1000} us, late {self.late}')
+        print('task;runs;busy_us;max_busy_us;max_wait_us')
+        for s in self.stats.values():
+            print(f'{s.name};{s.runs};{s.busy_ns // 1000};{s.max_busy_ns // 1000};{s.max_wait_ns // 1000}')
+
+    def run(self, *tasks):
+        async def main():
+            await asyncio.gather(*tasks)
+        self.running = True
+        asyncio.run(main())
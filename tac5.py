@@ -14,6 +14,7 @@ import storage
 import time
 import usb_cdc
 
+import pack
 import pcm
 
 status = digitalio.DigitalInOut(board.A1)
@@ -118,6 +119,100 @@ def print_tuple(t, format=';'):
     else:
         raise ValueError('Unrecognized format')
     
+def scan(block, channels, width, watch, last, level=None, slope=None):
+    # Checks one block for a level or slope trigger on the watched channels.
+    # last holds each channel's previous sample and is updated for the next
+    # block.  With ulab the whole block is handled as a (frames, channels)
+    # array, in single precision floats since ulab has no 32 bit integers,
+    # which is exact up to 24 bit samples and close enough at 32.
+    np = pack.np
+    n = len(block)
+    frames = n // channels
+    sign = 1 << (width - 1)
+    full = 1 << width
+    if np is None:
+        hit = False
+        for c in watch:
+            previous = last[c]
+            for i in range(c, frames * channels, channels):
+                s = block[i]
+                if s & sign:
+                    s -= full
+                if level is not None and (s >= level or -s >= level):
+                    hit = True
+                if slope is not None:
+                    d = s - previous
+                    if (slope > 0 and d >= slope) or (slope < 0 and d <= slope):
+                        hit = True
+                previous = s
+                if hit:
+                    break
+            last[c] = previous
+            if hit:
+                break
+        return hit
+
+    mask = (1 << width) - 1
+    dtype = np.int64 if hasattr(np, 'int64') else np.float
+    halves = np.frombuffer(block, dtype=np.uint16)
+    v = np.array(np.bitwise_and(halves[0:2*n:2], mask & 0xFFFF), dtype=dtype)
+    if width > 16:
+        v = v + np.array(np.bitwise_and(halves[1:2*n:2], mask >> 16), dtype=dtype) * 65536
+    v = v - (v >= sign) * full
+    v = v.reshape((frames, channels))
+    if level is not None:
+        peak = np.max(abs(v), axis=0)
+    if slope is not None and frames > 1:
+        d = np.diff(v, axis=0)
+        rise = np.max(d, axis=0)
+        fall = np.min(d, axis=0)
+    hit = False
+    for c in watch:
+        if level is not None and peak[c] >= level:
+            hit = True
+        if slope is not None:
+            first = v[0, c] - last[c]
+            if slope > 0 and (first >= slope or (frames > 1 and rise[c] >= slope)):
+                hit = True
+            if slope < 0 and (first <= slope or (frames > 1 and fall[c] <= slope)):
+                hit = True
+        last[c] = v[frames - 1, c]
+    return hit
+
+class TapeWriter():
+    # Writes recorded blocks to an open file, either as raw words or, with
+    # packed=True, in the format from pack.py, decoded on the host with
+    # pack.py.  The encoder counts blocks which took longer than their block
+    # period to encode, and drops the (experimental) Rice stage if that is
+    # the cause.
+    def __init__(self, f, channels, width, sample_rate, packed=False, rice=False):
+        if rice and not packed:
+            raise ValueError('rice requires packed')
+        self.f = f
+        self.blocks = 0
+        self.encoder = None
+        if packed:
+            self.encoder = pack.Encoder(channels=channels, width=width,
+                                        sample_rate=sample_rate, rice=rice)
+            f.write(self.encoder.header())
+
+    def write(self, b):
+        status.value = True
+        if self.encoder is None:
+            self.f.write(b)
+        else:
+            self.f.write(self.encoder.encode(b))
+        status.value = False
+        self.blocks += 1
+
+    def report(self):
+        if self.encoder is None:
+            print(f'\nBlocks: {self.blocks}')
+            return 0
+        e = self.encoder
+        print(f'\nBlocks: {self.blocks} Overruns: {e.overruns} Max encode: {e.max_encode_ns // 1000} us')
+        return e.overruns
+
 class TAC5():
     """
     >>> import tac5
@@ -394,10 +489,104 @@ class TAC5():
             else:
                 self.pcm.pio.background_read(loop=self.record_loop_buffer)
 
-    def tape(self, filename):
-        with open(filename, 'w') as f:
-            while True:
-                f.write(self.pcm.pio.last_read)
+    def tape_writer(self, f, packed=False, rice=False):
+        return TapeWriter(f, self.channels, self.width, self.sample_rate, packed=packed, rice=rice)
+
+    def tape(self, filename, packed=False, rice=False, blocks=None):
+        with open(filename, 'wb') as f:
+            writer = self.tape_writer(f, packed=packed, rice=rice)
+            if packed:
+                print('taping', filename, '...')
+            while blocks is None or writer.blocks < blocks:
+                b = self.pcm.pio.last_read
+                if len(b) > 0:
+                    writer.write(b)
+        return writer.report()
+
+    def trigger(self, filename, level=None, slope=None, mask=None, pre=4, post=4, events=1, packed=False):
+        # Watch blocks from last_read and save pre + post trigger blocks to a
+        # file when a masked channel crosses level (absolute value) or changes
+        # by slope from one sample to the next (negative slope for falling).
+        # Recording has to be double buffered, rec(double_buffer=True), so
+        # that the block being copied isn't the one the DMA is filling.
+        # Each block is copied into a ring holding the last `pre` blocks plus
+        # the one being scanned, and after a trigger the next `post` blocks
+        # are copied into memory too, so nothing waits on the SD card until
+        # the capture is complete.  Blocks arriving more than 1.5 periods
+        # apart are counted as dropped.  With events=None this runs forever,
+        # and filename can contain {} to number the events, e.g. '/event{}.raw'.
+        if level is None and slope is None:
+            raise ValueError('No trigger specified!')
+        if self.record_loop_buffer is None or self.record_loop2_buffer is None:
+            raise ValueError('trigger needs double buffered recording, use rec(double_buffer=True)')
+        if mask is None:
+            mask = (1 << self.channels) - 1
+        watch = [c for c in range(self.channels) if mask & (1 << c)]
+        # the once buffer can have a different length from the loop
+        # buffers, blocks of any other size are skipped
+        size = len(self.record_loop_buffer)
+        period = size // self.channels * 1_000_000_000 // self.sample_rate
+        ring = [array.array('L', [0] * size) for i in range(pre + 1 + post)]
+        event = 0
+        dropped = 0
+        scanned = 0
+        scan_ns = 0
+
+        print('armed...')
+        while events is None or event < events:
+            # re-arm: empty history, and seed the slope test from the first
+            # sample rather than from zero
+            head = 0
+            filled = 0
+            last = None
+            arrived = 0
+            hit = False
+            while not hit:
+                b = self.pcm.pio.last_read
+                if len(b) != size:
+                    continue
+                now = time.monotonic_ns()
+                if arrived > 0 and now - arrived > period * 3 // 2:
+                    dropped += 1
+                arrived = now
+                status.value = True
+                block = ring[head]
+                memoryview(block)[:] = b
+                head = (head + 1) % (pre + 1)
+                filled = min(filled + 1, pre + 1)
+                if last is None:
+                    last = [bits2int(block[c], self.width) for c in range(self.channels)]
+                hit = scan(block, self.channels, self.width, watch, last, level, slope)
+                status.value = False
+                scan_ns += time.monotonic_ns() - now
+                scanned += size // self.channels
+
+            before = dropped
+            saved = 0
+            while saved < post:
+                b = self.pcm.pio.last_read
+                if len(b) != size:
+                    continue
+                now = time.monotonic_ns()
+                if now - arrived > period * 3 // 2:
+                    dropped += 1
+                arrived = now
+                memoryview(ring[pre + 1 + saved])[:] = b
+                saved += 1
+
+            name = filename.format(event)
+            if dropped > before:
+                print(f'triggered, saving {name} ({dropped - before} blocks dropped) ...')
+            else:
+                print(f'triggered, saving {name} ...')
+            history = [ring[(head - filled + i) % (pre + 1)] for i in range(filled)]
+            with open(name, 'wb') as f:
+                writer = self.tape_writer(f, packed=packed)
+                for block in history + ring[pre + 1:]:
+                    writer.write(block)
+            event += 1
+        print(f'\nScanned {scanned / self.sample_rate:.1f} s of audio in {scan_ns / 1e9:.1f} s, dropped {dropped} blocks')
+        return event
 
     def show(self, buffer, slice=slice(None), format=';', shift=True, show_time=False, loop=False, delay=0):
         once = True